@@ -1,7 +1,21 @@
 import streamlit as st
 import pandas as pd
 import matplotlib.pyplot as plt
+import altair as alt
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+import urllib.request
+from collections import deque
 from datetime import datetime, timedelta
 import sqlite3
 from PIL import Image
@@ -74,20 +88,23 @@ st.markdown(
 
 
 # FUNCIONES MEJORADAS
-def format_currency(value):
+def format_currency(value, moneda=None):
     """Formato de moneda argentino mejorado"""
+    sufijo = f" {moneda}" if moneda and moneda != "ARS" else ""
     try:
         value = float(value)
         if value >= 1000:
             return (
                 f"${value:,.0f}".replace(",", "X").replace(".", ",").replace("X", ".")
+                + sufijo
             )
         else:
             return (
                 f"${value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+                + sufijo
             )
     except:
-        return f"${value}"
+        return f"${value}{sufijo}"
 
 
 def convertir_a_numero(valor):
@@ -132,6 +149,161 @@ def sugerir_sl_tp_inteligente(precio_compra, activo):
     return round(stop_loss, 2), round(take_profit, 2)
 
 
+# La matriz cambia con cada cotización en vivo: se acota la cantidad de entradas
+@st.cache_data(show_spinner=False, max_entries=16)
+def calcular_portafolio_ars(portafolio, matriz, moneda_reporte="ARS"):
+    """Valoriza el portafolio en ARS y en la moneda de reporte (cacheado)"""
+    portafolio_copy = portafolio.copy()
+    portafolio_copy["Monto_Invertido"] = portafolio_copy["Monto_Invertido"].apply(
+        convertir_a_numero
+    )
+    portafolio_copy["Monto_ARS"] = convertir_montos(
+        portafolio_copy["Monto_Invertido"], portafolio_copy["Moneda"], "ARS", matriz
+    )
+    portafolio_copy["Monto_Reporte"] = convertir_montos(
+        portafolio_copy["Monto_Invertido"],
+        portafolio_copy["Moneda"],
+        moneda_reporte,
+        matriz,
+    )
+    return portafolio_copy
+
+
+def calcular_acumulados(libro_trading):
+    """Resultado acumulado por moneda (una columna cada una), ordenado por fecha"""
+    ordenado = libro_trading.sort_values("Fecha_Entrada", kind="stable")
+    por_moneda = pd.get_dummies(ordenado["Moneda"].astype(str), dtype=float).mul(
+        ordenado["Resultado"], axis=0
+    )
+    acumulados = por_moneda.cumsum()
+    acumulados.index = ordenado["Fecha_Entrada"]
+    return acumulados
+
+
+def calcular_evolucion_capital(acumulados, factores):
+    """Curva de capital en la moneda de reporte: un producto matriz-vector"""
+    return pd.DataFrame(
+        {
+            "Fecha": acumulados.index,
+            "Acumulado_Total": acumulados.to_numpy()
+            @ factores.reindex(acumulados.columns).fillna(0.0).to_numpy(),
+        }
+    )
+
+
+def calcular_estadisticas(libro_trading):
+    total_ops = len(libro_trading)
+    ganadoras = int((libro_trading["Resultado"] > 0).sum())
+    return {
+        "total_ops": total_ops,
+        "ganadoras": ganadoras,
+        "tasa_acierto": (ganadoras / total_ops * 100) if total_ops > 0 else 0,
+        "resultado_por_moneda": libro_trading.groupby("Moneda", observed=True)[
+            "Resultado"
+        ].sum(),
+    }
+
+
+# GRÁFICOS INTERACTIVOS (Vega-Lite: el navegador dibuja, el servidor solo envía datos)
+COLORES_GRAFICOS = ["#1a2a6c", "#0047ab", "#0066cc", "#0088cc", "#00aacc", "#00ccdd"]
+
+
+def grafico_torta_altair(serie, categoria, titulo):
+    """Gráfico de torta a partir de una serie agregada (índice = categoría)"""
+    datos = serie.rename("Monto").rename_axis(categoria).reset_index()
+    datos["Porcentaje"] = datos["Monto"] / datos["Monto"].sum()
+    return (
+        alt.Chart(datos, title=titulo)
+        .mark_arc(innerRadius=0, stroke="white")
+        .encode(
+            theta=alt.Theta("Monto:Q"),
+            color=alt.Color(f"{categoria}:N", scale=alt.Scale(range=COLORES_GRAFICOS)),
+            tooltip=[
+                alt.Tooltip(f"{categoria}:N"),
+                alt.Tooltip("Monto:Q", format=",.0f"),
+                alt.Tooltip("Porcentaje:Q", format=".1%"),
+            ],
+        )
+    )
+
+
+def grafico_barras_altair(serie, categoria, titulo, titulo_eje="Monto en ARS"):
+    """Barras horizontales a partir de una serie agregada (índice = categoría)"""
+    datos = serie.rename("Monto").rename_axis(categoria).reset_index()
+    return (
+        alt.Chart(datos, title=titulo)
+        .mark_bar(color="#0047ab")
+        .encode(
+            x=alt.X("Monto:Q", title=titulo_eje),
+            y=alt.Y(f"{categoria}:N", sort="-x", title=None),
+            tooltip=[
+                alt.Tooltip(f"{categoria}:N"),
+                alt.Tooltip("Monto:Q", format=",.0f"),
+            ],
+        )
+    )
+
+
+def grafico_evolucion_altair(df_evolucion):
+    """Curva de capital con zoom y tooltips; solo viajan fecha y acumulado"""
+    datos = df_evolucion[["Fecha", "Acumulado_Total"]]
+    return (
+        alt.Chart(datos, title="Evolución del Capital")
+        .mark_line(color="#1a2a6c", strokeWidth=3, point=True)
+        .encode(
+            x=alt.X("Fecha:T", title="Fecha"),
+            y=alt.Y("Acumulado_Total:Q", title="Resultado Acumulado ($)"),
+            tooltip=[
+                alt.Tooltip("Fecha:T"),
+                alt.Tooltip("Acumulado_Total:Q", format=",.2f"),
+            ],
+        )
+        .interactive()
+    )
+
+
+def grafico_riesgo_beneficio_altair(inversion_total, perdida, ganancia):
+    """Barra de riesgo/beneficio alrededor del capital invertido"""
+    datos = pd.DataFrame(
+        [
+            {
+                "Tramo": "Pérdida",
+                "Desde": inversion_total - perdida,
+                "Hasta": inversion_total,
+            },
+            {
+                "Tramo": "Ganancia",
+                "Desde": inversion_total,
+                "Hasta": inversion_total + ganancia,
+            },
+        ]
+    )
+    barras = (
+        alt.Chart(datos)
+        .mark_bar(height=30)
+        .encode(
+            x=alt.X("Desde:Q", title="Capital ($)"),
+            x2="Hasta:Q",
+            color=alt.Color(
+                "Tramo:N",
+                scale=alt.Scale(domain=["Ganancia", "Pérdida"], range=["green", "red"]),
+                legend=alt.Legend(orient="bottom"),
+            ),
+            tooltip=[
+                "Tramo:N",
+                alt.Tooltip("Desde:Q", format=",.2f"),
+                alt.Tooltip("Hasta:Q", format=",.2f"),
+            ],
+        )
+    )
+    linea = (
+        alt.Chart(pd.DataFrame({"Inversión": [inversion_total]}))
+        .mark_rule(color="black", strokeDash=[5, 5])
+        .encode(x="Inversión:Q")
+    )
+    return (barras + linea).properties(height=120)
+
+
 # Lista de brokers predefinidos
 BROKERS_PREDEFINIDOS = [
     "BALANZ",
@@ -152,8 +324,83 @@ BROKERS_PREDEFINIDOS = [
     "LETSRIPO",
 ]
 
+TIPOS_ACTIVO = [
+    "CEDEARs",
+    "Acciones",
+    "Bonos",
+    "Fondos",
+    "Cripto",
+    "Letras",
+    "ONs",
+    "Otros",
+    "Causión",
+    "Dolar",
+]
+MONEDAS = ["ARS", "USD", "USD MEP", "USD CCL", "USDT", "USDC", "DAI", "EUR", "BRL"]
+TIPOS_RENTA = ["Variable", "Fija", "Mixta"]
+OPERACIONES = ["COMPRA", "VENTA"]
+ESTRATEGIAS = ["ANÁLISIS TÉCNICO", "ANÁLISIS FUNDAMENTAL", "MIXTA"]
+
+# Esquemas tipados de las tablas en memoria: categóricas para las enumeraciones,
+# fechas datetime64 y enteros chicos para ahorrar memoria por sesión
+ESQUEMA_PORTAFOLIO = {
+    "Tipo_Activo": pd.CategoricalDtype(TIPOS_ACTIVO),
+    "Broker": pd.CategoricalDtype(BROKERS_PREDEFINIDOS),
+    "Monto_Invertido": "float64",
+    "Moneda": pd.CategoricalDtype(MONEDAS),
+    "Renta": pd.CategoricalDtype(TIPOS_RENTA),
+}
+
+ESQUEMA_OPERACIONES = {
+    "Fecha_Entrada": "datetime64[s]",
+    "Fecha_Salida": "datetime64[s]",
+    "Activo": "category",
+    "Operacion": pd.CategoricalDtype(OPERACIONES),
+    "Cantidad": "float64",
+    "Precio_Entrada": "float64",
+    "Precio_Salida": "float64",
+    "Inversion_Total": "float64",
+    "Resultado": "float64",
+    "ROI": "float64",
+    "Duracion": "int32",
+    "Estrategia": pd.CategoricalDtype(ESTRATEGIAS),
+    "Notas": "object",
+    "Moneda": pd.CategoricalDtype(MONEDAS),
+}
+
+
+def aplicar_esquema(df, esquema):
+    """Devuelve una copia con exactamente las columnas y tipos del esquema"""
+    df = df.reindex(columns=list(esquema))
+    for columna, tipo in esquema.items():
+        serie = df[columna]
+        if isinstance(tipo, pd.CategoricalDtype):
+            # Valores fuera de la lista (datos viejos) se agregan, no se pierden
+            extra = sorted(set(serie.dropna().astype(str)) - set(tipo.categories))
+            df[columna] = (
+                serie.astype(str)
+                .where(serie.notna())
+                .astype(pd.CategoricalDtype(list(tipo.categories) + extra))
+            )
+        elif tipo == "category":
+            df[columna] = serie.astype(str).where(serie.notna()).astype("category")
+        elif tipo.startswith("datetime64"):
+            df[columna] = pd.to_datetime(
+                serie, errors="coerce", format="ISO8601"
+            ).astype(tipo)
+        elif tipo == "float64":
+            if not pd.api.types.is_numeric_dtype(serie):
+                serie = serie.map(convertir_a_numero)
+            df[columna] = pd.to_numeric(serie, errors="coerce").astype(tipo)
+        elif tipo == "int32":
+            df[columna] = pd.to_numeric(serie, errors="coerce").fillna(0).astype(tipo)
+        else:
+            df[columna] = serie.fillna("").astype(tipo)
+    return df
+
 
-# Inicializar la base de datos
+# Inicializar la base de datos (una vez por proceso)
+@st.cache_resource
 def init_db():
     conn = sqlite3.connect("trade_analytics.db")
     c = conn.cursor()
@@ -175,10 +422,15 @@ def init_db():
             Fecha_Entrada TEXT, Fecha_Salida TEXT, Activo TEXT,
             Operacion TEXT, Cantidad REAL, Precio_Entrada REAL,
             Precio_Salida REAL, Inversion_Total REAL, Resultado REAL,
-            ROI REAL, Duracion INTEGER, Estrategia TEXT, Notas TEXT
+            ROI REAL, Duracion INTEGER, Estrategia TEXT, Notas TEXT,
+            Moneda TEXT DEFAULT 'ARS'
         )
     """
     )
+    # Bases anteriores al soporte multimoneda: los resultados eran en ARS
+    columnas = [fila[1] for fila in c.execute("PRAGMA table_info(operaciones)")]
+    if "Moneda" not in columnas:
+        c.execute("ALTER TABLE operaciones ADD COLUMN Moneda TEXT DEFAULT 'ARS'")
 
     c.execute(
         """
@@ -189,107 +441,1017 @@ def init_db():
     """
     )
 
-    # Cargar datos existentes
-    try:
-        portafolio_db = pd.read_sql_query("SELECT * FROM portafolio", conn)
-        st.session_state.portafolio = (
-            portafolio_db.drop("id", axis=1)
-            if not portafolio_db.empty
-            else pd.DataFrame(
-                columns=["Tipo_Activo", "Broker", "Monto_Invertido", "Moneda", "Renta"]
-            )
+    # Valor en ARS de una unidad de cada moneda (EUR, BRL, dólar MEP/CCL, ...)
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tipos_cambio (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TEXT, moneda TEXT, valor_ars REAL
         )
-    except:
-        st.session_state.portafolio = pd.DataFrame(
-            columns=["Tipo_Activo", "Broker", "Monto_Invertido", "Moneda", "Renta"]
+    """
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_tipos_cambio ON tipos_cambio (moneda, fecha)"
+    )
+
+    # Piernas individuales (compras/ventas parciales) y lotes abiertos por activo
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS movimientos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            Fecha TEXT, Activo TEXT, Lado TEXT, Cantidad REAL,
+            Precio REAL, Metodo TEXT, Resultado REAL
+        )
+    """
+    )
+
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS lotes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            Activo TEXT, Fecha TEXT, Cantidad REAL, Precio REAL
         )
+    """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lotes_activo ON lotes (Activo)")
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_movimientos_activo ON movimientos (Activo)"
+    )
+
+    # Valor diario del portafolio en ARS por tipo de activo, broker y total
+    c.execute(
+        """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            Fecha TEXT, Dimension TEXT, Categoria TEXT, Valor_ARS REAL
+        )
+    """
+    )
+    c.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_snapshots "
+        "ON snapshots (Dimension, Fecha, Categoria)"
+    )
+
+    # Índices para los filtros del historial
+    for columna in ["Activo", "Estrategia", "Operacion"]:
+        c.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_operaciones_{columna.lower()} "
+            f"ON operaciones ({columna}, Fecha_Entrada)"
+        )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_operaciones_fecha ON operaciones (Fecha_Entrada)"
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_operaciones_resultado ON operaciones (Resultado)"
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_operaciones_roi ON operaciones (ROI)")
 
+    # Búsqueda de texto completo en las notas (si SQLite trae FTS5)
     try:
-        operaciones_db = pd.read_sql_query("SELECT * FROM operaciones", conn)
-        st.session_state.libro_trading = (
-            operaciones_db.drop("id", axis=1)
-            if not operaciones_db.empty
-            else pd.DataFrame(
-                columns=[
-                    "Fecha_Entrada",
-                    "Fecha_Salida",
-                    "Activo",
-                    "Operacion",
-                    "Cantidad",
-                    "Precio_Entrada",
-                    "Precio_Salida",
-                    "Inversion_Total",
-                    "Resultado",
-                    "ROI",
-                    "Duracion",
-                    "Estrategia",
-                    "Notas",
-                ]
+        existia = c.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'operaciones_fts'"
+        ).fetchone()
+        c.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS operaciones_fts USING fts5(
+                Notas, content='operaciones', content_rowid='id'
             )
+        """
+        )
+        c.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS operaciones_fts_ai AFTER INSERT ON operaciones
+            BEGIN
+                INSERT INTO operaciones_fts (rowid, Notas) VALUES (new.id, new.Notas);
+            END
+        """
+        )
+        c.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS operaciones_fts_ad AFTER DELETE ON operaciones
+            BEGIN
+                INSERT INTO operaciones_fts (operaciones_fts, rowid, Notas)
+                VALUES ('delete', old.id, old.Notas);
+            END
+        """
+        )
+        c.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS operaciones_fts_au AFTER UPDATE ON operaciones
+            BEGIN
+                INSERT INTO operaciones_fts (operaciones_fts, rowid, Notas)
+                VALUES ('delete', old.id, old.Notas);
+                INSERT INTO operaciones_fts (rowid, Notas) VALUES (new.id, new.Notas);
+            END
+        """
         )
+        if not existia:
+            # Indexar las notas que ya estaban cargadas
+            c.execute(
+                "INSERT INTO operaciones_fts (operaciones_fts) VALUES ('rebuild')"
+            )
+    except sqlite3.OperationalError:
+        pass
+
+    conn.commit()
+    conn.close()
+
+
+def leer_portafolio():
+    conn = sqlite3.connect("trade_analytics.db")
+    try:
+        portafolio_db = pd.read_sql_query("SELECT * FROM portafolio", conn)
+        return aplicar_esquema(portafolio_db.drop("id", axis=1), ESQUEMA_PORTAFOLIO)
     except:
-        st.session_state.libro_trading = pd.DataFrame(
-            columns=[
-                "Fecha_Entrada",
-                "Fecha_Salida",
-                "Activo",
-                "Operacion",
-                "Cantidad",
-                "Precio_Entrada",
-                "Precio_Salida",
-                "Inversion_Total",
-                "Resultado",
-                "ROI",
-                "Duracion",
-                "Estrategia",
-                "Notas",
-            ]
+        return aplicar_esquema(pd.DataFrame(), ESQUEMA_PORTAFOLIO)
+    finally:
+        conn.close()
+
+
+def leer_operaciones():
+    """Libro de trading indexado por el id de la base (para poder eliminar)"""
+    conn = sqlite3.connect("trade_analytics.db")
+    try:
+        operaciones_db = pd.read_sql_query(
+            "SELECT * FROM operaciones", conn, index_col="id"
         )
+        return aplicar_esquema(operaciones_db, ESQUEMA_OPERACIONES)
+    except:
+        return aplicar_esquema(pd.DataFrame(), ESQUEMA_OPERACIONES)
+    finally:
+        conn.close()
 
+
+def leer_cotizacion_usd():
+    conn = sqlite3.connect("trade_analytics.db")
     try:
         cotizacion_db = pd.read_sql_query(
             "SELECT valor_usd FROM cotizaciones ORDER BY fecha DESC LIMIT 1", conn
         )
-        st.session_state.cotizacion_usd = (
-            cotizacion_db["valor_usd"].iloc[0] if not cotizacion_db.empty else 1000.0
+        return cotizacion_db["valor_usd"].iloc[0] if not cotizacion_db.empty else 1000.0
+    except:
+        return 1000.0
+    finally:
+        conn.close()
+
+
+# ============================================================
+# CACHÉ COMPARTIDA DE LECTURA (una copia por proceso)
+# ============================================================
+class CacheTablas:
+    """Copia única de cada tabla y sus agregados, compartida por todas las sesiones.
+
+    Lo que devuelve `obtener` es una referencia compartida: no se modifica en el
+    lugar. Toda escritura en la base llama a `invalidar`, que sube la versión y
+    descarta las entradas para que la próxima lectura vuelva a la base.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._entradas = {}
+        self._locks_claves = {}
+
+    def obtener(self, clave, cargar):
+        with self._lock:
+            if clave in self._entradas:
+                return self._entradas[clave]
+            lock_clave = self._locks_claves.setdefault(clave, threading.Lock())
+
+        # Una sola carga por clave; quien pide otra clave no espera esta lectura
+        with lock_clave:
+            with self._lock:
+                if clave in self._entradas:
+                    return self._entradas[clave]
+                version = self.version
+            valor = cargar()
+            with self._lock:
+                # Si se invalidó durante la carga, el resultado no se guarda
+                if self.version == version:
+                    self._entradas[clave] = valor
+            return valor
+
+    def invalidar(self):
+        with self._lock:
+            self.version += 1
+            self._entradas.clear()
+
+
+@st.cache_resource
+def cache_tablas():
+    return CacheTablas()
+
+
+def cargar_tablas():
+    """Referencias de la sesión a las tablas compartidas (sin copiar datos)"""
+    cache = cache_tablas()
+    # La versión se toma antes de leer: si cambia en el medio, se recarga después
+    st.session_state.version_tablas = cache.version
+    st.session_state.portafolio = cache.obtener("portafolio", leer_portafolio)
+    st.session_state.libro_trading = cache.obtener("libro_trading", leer_operaciones)
+    st.session_state.cotizacion_usd = cache.obtener(
+        "cotizacion_usd", leer_cotizacion_usd
+    )
+
+
+def tablas_al_dia():
+    """En reruns de fragmento, recarga si otra sesión escribió en la base"""
+    if st.session_state.get("version_tablas") != cache_tablas().version:
+        cargar_tablas()
+
+
+def evolucion_capital(factores):
+    """Curva de capital: acumulados por moneda cacheados, conversión al vuelo"""
+    cache = cache_tablas()
+    acumulados = cache.obtener(
+        "acumulados_capital",
+        lambda: calcular_acumulados(historial_completo(COLUMNAS_ANALITICAS)),
+    )
+    return calcular_evolucion_capital(acumulados, factores)
+
+
+def estadisticas_libro():
+    """Totales del libro de trading, calculados una vez por versión"""
+    cache = cache_tablas()
+    return cache.obtener(
+        "estadisticas_libro",
+        lambda: calcular_estadisticas(historial_completo(COLUMNAS_ANALITICAS)),
+    )
+
+
+# ============================================================
+# BÚSQUEDA EN EL LIBRO DE TRADING
+# ============================================================
+def sin_acentos(texto):
+    """Texto sin marcas diacríticas, para comparar como lo hace FTS5"""
+    return "".join(
+        c for c in unicodedata.normalize("NFD", texto) if not unicodedata.combining(c)
+    )
+
+
+def patron_prefijo(termino):
+    """Regex equivalente a `"termino"*` en FTS5 (unicode61) sobre texto sin acentos"""
+    # FTS5 parte el término en tokens alfanuméricos que deben ir seguidos
+    tokens = re.findall(r"[^\W_]+", termino)
+    if not tokens:
+        return None
+    separador = r"[^\p{L}\p{N}]+"
+    return r"(^|[^\p{L}\p{N}])" + separador.join(re.escape(t) for t in tokens)
+
+
+def consulta_fts(texto):
+    """Convierte el texto libre en una consulta FTS5 segura (todas las palabras)"""
+    terminos = [t.replace('"', '""') for t in texto.split()]
+    return " ".join(f'"{t}"*' for t in terminos)
+
+
+def buscar_operaciones(
+    texto="",
+    activos=(),
+    estrategias=(),
+    operaciones=(),
+    desde=None,
+    hasta=None,
+    resultado_min=None,
+    roi_min=None,
+    moneda_resultado="ARS",
+):
+    """Filtra el libro en SQLite usando los índices y el índice FTS de las notas"""
+    condiciones, parametros = [], []
+    for columna, valores in [
+        ("Activo", activos),
+        ("Estrategia", estrategias),
+        ("Operacion", operaciones),
+    ]:
+        if valores:
+            condiciones.append(f"{columna} IN ({', '.join('?' * len(valores))})")
+            parametros += list(valores)
+    if desde is not None:
+        condiciones.append("Fecha_Entrada >= ?")
+        parametros.append(str(desde))
+    if hasta is not None:
+        # Las fechas pueden venir con hora: se compara contra el día siguiente
+        condiciones.append("Fecha_Entrada < ?")
+        parametros.append(str(hasta + timedelta(days=1)))
+    umbrales = None
+    if resultado_min is not None:
+        # El mínimo está en `moneda_resultado`: se lleva a la moneda de cada
+        # operación; las monedas sin tipo de cambio no pueden cumplirlo
+        umbrales = (resultado_min * matriz_cambio().loc[moneda_resultado]).dropna()
+        condiciones.append(
+            "("
+            + " OR ".join(
+                ["(COALESCE(Moneda, 'ARS') = ? AND Resultado >= ?)"] * len(umbrales)
+                or ["0"]
+            )
+            + ")"
+        )
+        for moneda, umbral in umbrales.items():
+            parametros += [moneda, float(umbral)]
+    if roi_min is not None:
+        condiciones.append("ROI >= ?")
+        parametros.append(roi_min)
+
+    conn = sqlite3.connect("trade_analytics.db")
+    try:
+        if texto.strip():
+            tiene_fts = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'operaciones_fts'"
+            ).fetchone()
+            if tiene_fts:
+                condiciones.append(
+                    "id IN (SELECT rowid FROM operaciones_fts "
+                    "WHERE operaciones_fts MATCH ?)"
+                )
+                parametros.append(consulta_fts(texto))
+            else:
+                condiciones.append("Notas LIKE ?")
+                parametros.append(f"%{texto.strip()}%")
+
+        consulta = "SELECT * FROM operaciones"
+        if condiciones:
+            consulta += " WHERE " + " AND ".join(condiciones)
+        operaciones_db = pd.read_sql_query(
+            consulta + " ORDER BY id", conn, params=parametros, index_col="id"
+        )
+    finally:
+        conn.close()
+
+    archivadas = sin_duplicados(
+        buscar_archivo(
+            texto,
+            activos,
+            estrategias,
+            operaciones,
+            desde,
+            hasta,
+            umbrales,
+            roi_min,
+        ),
+        cache_tablas().obtener("libro_trading", leer_operaciones).index,
+    )
+    if not archivadas.empty:
+        operaciones_db = pd.concat([archivadas, operaciones_db]).sort_index()
+    return aplicar_esquema(operaciones_db, ESQUEMA_OPERACIONES)
+
+
+# ============================================================
+# ALMACENAMIENTO EN NIVELES (operaciones viejas en Parquet)
+# ============================================================
+DIRECTORIO_ARCHIVO = os.environ.get("TAP_DIRECTORIO_ARCHIVO", "archivo_operaciones")
+# Días desde el cierre para archivar al iniciar (0 = archivar solo a mano)
+HORIZONTE_ARCHIVO = int(os.environ.get("TAP_HORIZONTE_ARCHIVO", "0"))
+# Lo único que leen la curva de capital y las estadísticas
+COLUMNAS_ANALITICAS = ["Fecha_Entrada", "Resultado", "Moneda"]
+
+
+def tipo_arrow(tipo):
+    if tipo == "datetime64[s]":
+        return pa.timestamp("s")
+    if tipo == "float64":
+        return pa.float64()
+    if tipo == "int32":
+        return pa.int32()
+    # Categorías y texto libre se guardan como texto plano
+    return pa.string()
+
+
+# Particionado por año de entrada: los filtros por fecha saltean directorios
+ESQUEMA_ARCHIVO = pa.schema(
+    [("id", pa.int64())]
+    + [(columna, tipo_arrow(tipo)) for columna, tipo in ESQUEMA_OPERACIONES.items()]
+    + [("Anio", pa.int32())]
+)
+
+
+def leer_archivo(columnas=None, filtro=None):
+    """Lee el archivo con memory map, trayendo solo las columnas pedidas"""
+    esquema = (
+        ESQUEMA_OPERACIONES
+        if columnas is None
+        else {columna: ESQUEMA_OPERACIONES[columna] for columna in columnas}
+    )
+    if not os.path.isdir(DIRECTORIO_ARCHIVO):
+        return aplicar_esquema(pd.DataFrame(), esquema)
+    tabla = pq.read_table(
+        DIRECTORIO_ARCHIVO,
+        columns=["id"] + list(esquema),
+        filters=filtro,
+        schema=ESQUEMA_ARCHIVO,
+        partitioning="hive",
+        memory_map=True,
+    )
+    return aplicar_esquema(tabla.to_pandas().set_index("id"), esquema)
+
+
+def sin_duplicados(archivo, ids_calientes):
+    """Un id que sigue en SQLite manda; del archivo vale la primera copia"""
+    # Un archivado cortado entre la escritura y el borrado deja el id en ambos
+    return archivo[~archivo.index.isin(ids_calientes) & ~archivo.index.duplicated()]
+
+
+def historial_completo(columnas=None):
+    """Operaciones de los dos niveles: archivo Parquet y tabla de SQLite"""
+    caliente = cache_tablas().obtener("libro_trading", leer_operaciones)
+    archivo = sin_duplicados(leer_archivo(columnas), caliente.index)
+    if columnas is not None:
+        caliente = caliente[columnas]
+    if archivo.empty:
+        return caliente
+    return aplicar_esquema(
+        pd.concat([archivo, caliente]),
+        {columna: ESQUEMA_OPERACIONES[columna] for columna in caliente.columns},
+    )
+
+
+def activos_historicos():
+    """Activos de ambos niveles, para los filtros de búsqueda"""
+    return cache_tablas().obtener(
+        "activos_historicos",
+        lambda: sorted(
+            set(historial_completo(["Activo"])["Activo"].dropna().astype(str))
+        ),
+    )
+
+
+def buscar_archivo(
+    texto, activos, estrategias, operaciones, desde, hasta, umbrales, roi_min
+):
+    """Los mismos filtros de la búsqueda, empujados al lector de Parquet"""
+    if not os.path.isdir(DIRECTORIO_ARCHIVO):
+        return aplicar_esquema(pd.DataFrame(), ESQUEMA_OPERACIONES)
+
+    condiciones = []
+    for columna, valores in [
+        ("Activo", activos),
+        ("Estrategia", estrategias),
+        ("Operacion", operaciones),
+    ]:
+        if valores:
+            condiciones.append(ds.field(columna).isin(list(valores)))
+    if desde is not None:
+        condiciones.append(ds.field("Anio") >= desde.year)
+        condiciones.append(
+            ds.field("Fecha_Entrada") >= datetime.combine(desde, datetime.min.time())
+        )
+    if hasta is not None:
+        condiciones.append(ds.field("Anio") <= hasta.year)
+        condiciones.append(
+            ds.field("Fecha_Entrada")
+            < datetime.combine(hasta + timedelta(days=1), datetime.min.time())
+        )
+    if umbrales is not None:
+        # Un umbral por moneda, ya convertido desde la moneda del filtro
+        por_moneda = pc.scalar(False)
+        moneda = pc.coalesce(ds.field("Moneda"), pc.scalar("ARS"))
+        for codigo, umbral in umbrales.items():
+            por_moneda = por_moneda | (
+                (moneda == codigo) & (ds.field("Resultado") >= float(umbral))
+            )
+        condiciones.append(por_moneda)
+    if roi_min is not None:
+        condiciones.append(ds.field("ROI") >= roi_min)
+
+    # Sin índice FTS en el archivo: la misma consulta que `consulta_fts`, cada
+    # término como prefijo de palabra, sin acentos ni mayúsculas
+    notas = pc.replace_substring_regex(
+        pc.utf8_normalize(ds.field("Notas"), "NFD"), r"\p{Mn}", ""
+    )
+    for termino in sin_acentos(texto).split():
+        patron = patron_prefijo(termino)
+        if patron:
+            condiciones.append(
+                pc.match_substring_regex(notas, patron, ignore_case=True)
+            )
+
+    if not condiciones:
+        return leer_archivo()
+    filtro = condiciones[0]
+    for condicion in condiciones[1:]:
+        filtro = filtro & condicion
+
+    # Primero solo los ids (columnas del filtro); las filas completas, después
+    ids = pq.read_table(
+        DIRECTORIO_ARCHIVO,
+        columns=["id"],
+        filters=filtro,
+        schema=ESQUEMA_ARCHIVO,
+        partitioning="hive",
+        memory_map=True,
+    )["id"]
+    if len(ids) == 0:
+        return aplicar_esquema(pd.DataFrame(), ESQUEMA_OPERACIONES)
+    return leer_archivo(filtro=ds.field("id").isin(ids))
+
+
+def archivar_operaciones(horizonte_dias):
+    """Mueve al archivo las operaciones cerradas hace más de N días"""
+    limite = (datetime.now().date() - timedelta(days=horizonte_dias)).isoformat()
+    conn = sqlite3.connect("trade_analytics.db")
+    try:
+        # Un solo archivado a la vez: otro que espere ya no encuentra estas filas
+        conn.execute("BEGIN IMMEDIATE")
+        viejas = pd.read_sql_query(
+            "SELECT * FROM operaciones WHERE Fecha_Salida < ?",
+            conn,
+            params=[limite],
+            index_col="id",
+        )
+        if viejas.empty:
+            return 0
+
+        datos = aplicar_esquema(viejas, ESQUEMA_OPERACIONES).reset_index()
+        for columna in datos.columns:
+            if isinstance(datos[columna].dtype, pd.CategoricalDtype):
+                datos[columna] = datos[columna].astype(object)
+        datos["Anio"] = datos["Fecha_Entrada"].dt.year.fillna(0).astype("int32")
+        pq.write_to_dataset(
+            pa.Table.from_pandas(datos, schema=ESQUEMA_ARCHIVO, preserve_index=False),
+            DIRECTORIO_ARCHIVO,
+            partition_cols=["Anio"],
+            basename_template=f"operaciones-{datetime.now():%Y%m%d%H%M%S%f}-{{i}}.parquet",
+        )
+
+        # Recién con los archivos escritos se borran de la tabla caliente
+        conn.executemany(
+            "DELETE FROM operaciones WHERE id = ?",
+            [(int(i),) for i in viejas.index],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    cache_tablas().invalidar()
+    return len(viejas)
+
+
+@st.cache_resource
+def archivo_automatico():
+    """Archivado al iniciar el proceso, si hay un horizonte configurado"""
+    if HORIZONTE_ARCHIVO > 0:
+        return archivar_operaciones(HORIZONTE_ARCHIVO)
+    return 0
+
+
+# ============================================================
+# MOTOR DE LOTES (compras y ventas parciales)
+# ============================================================
+METODOS_LOTES = ["FIFO", "LIFO", "PROMEDIO"]
+EPSILON_LOTES = 1e-9
+
+
+class MotorLotes:
+    """Colas de lotes abiertos por activo con P&L realizado pierna a pierna"""
+
+    def __init__(self, lotes=None):
+        self.lotes = {}
+        self.realizado = {}
+        if lotes is not None:
+            for lote in lotes.itertuples(index=False):
+                self.lotes.setdefault(lote.Activo, deque()).append(
+                    [lote.Fecha, float(lote.Cantidad), float(lote.Precio)]
+                )
+
+    def cantidad(self, activo):
+        return sum(lote[1] for lote in self.lotes.get(activo, ()))
+
+    def registrar(self, activo, lado, cantidad, precio, fecha, metodo="FIFO"):
+        """Aplica una pierna a la cola del activo y devuelve su resultado realizado"""
+        cola = self.lotes.setdefault(activo, deque())
+
+        if lado == "COMPRA":
+            cola.append([fecha, cantidad, precio])
+            # Compras cargadas con fecha anterior: la cola sigue el orden de fechas
+            if len(cola) > 1 and cola[-2][0] > fecha:
+                self.lotes[activo] = deque(sorted(cola, key=lambda lote: lote[0]))
+            return 0.0
+
+        # Una venta solo puede consumir lotes comprados hasta su fecha
+        vigentes = [lote for lote in cola if lote[0] <= fecha]
+        disponible = sum(lote[1] for lote in vigentes)
+        if cantidad > disponible + EPSILON_LOTES:
+            raise ValueError(
+                f"La venta de {cantidad:g} {activo} supera la posición abierta "
+                f"al {fecha} ({disponible:g})"
+            )
+
+        if metodo == "PROMEDIO":
+            # Costo promedio: todos los lotes se reducen en la misma proporción
+            precio_promedio = sum(lote[1] * lote[2] for lote in vigentes) / disponible
+            resultado = (precio - precio_promedio) * cantidad
+            proporcion = 1 - cantidad / disponible
+            for lote in vigentes:
+                lote[1] *= proporcion
+        else:
+            resultado = 0.0
+            pendiente = cantidad
+            for lote in vigentes if metodo == "FIFO" else reversed(vigentes):
+                if pendiente <= EPSILON_LOTES:
+                    break
+                usado = min(pendiente, lote[1])
+                resultado += (precio - lote[2]) * usado
+                lote[1] -= usado
+                pendiente -= usado
+
+        self.lotes[activo] = deque(lote for lote in cola if lote[1] > EPSILON_LOTES)
+        self.realizado[activo] = self.realizado.get(activo, 0.0) + resultado
+        return resultado
+
+
+def registrar_movimiento(fecha, activo, lado, cantidad, precio, metodo):
+    """Guarda una pierna actualizando solo los lotes de ese activo"""
+    conn = sqlite3.connect("trade_analytics.db")
+    try:
+        # Lock de escritura antes de leer: otra sesión no puede vender los
+        # mismos lotes entre la lectura y la reescritura
+        conn.execute("BEGIN IMMEDIATE")
+        # Las ventas ya registradas no se rearman: nada puede quedar antes de ellas
+        ultima_venta = conn.execute(
+            "SELECT MAX(Fecha) FROM movimientos WHERE Activo = ? AND Lado = 'VENTA'",
+            (activo,),
+        ).fetchone()[0]
+        if ultima_venta is not None and fecha < ultima_venta:
+            raise ValueError(
+                f"Ya hay una venta de {activo} registrada el {ultima_venta}: "
+                f"no se pueden cargar movimientos anteriores"
+            )
+        lotes_db = pd.read_sql_query(
+            "SELECT Activo, Fecha, Cantidad, Precio FROM lotes "
+            "WHERE Activo = ? ORDER BY Fecha, id",
+            conn,
+            params=(activo,),
+        )
+        motor = MotorLotes(lotes_db)
+        resultado = motor.registrar(activo, lado, cantidad, precio, fecha, metodo)
+
+        conn.execute("DELETE FROM lotes WHERE Activo = ?", (activo,))
+        conn.executemany(
+            "INSERT INTO lotes (Activo, Fecha, Cantidad, Precio) VALUES (?, ?, ?, ?)",
+            [(activo, *lote) for lote in motor.lotes[activo]],
+        )
+        conn.execute(
+            "INSERT INTO movimientos "
+            "(Fecha, Activo, Lado, Cantidad, Precio, Metodo, Resultado) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (fecha, activo, lado, cantidad, precio, metodo, resultado),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    cache_tablas().invalidar()
+    return resultado
+
+
+def consultar_posiciones():
+    """Posiciones abiertas y P&L realizado por activo, sin reprocesar el historial"""
+    conn = sqlite3.connect("trade_analytics.db")
+    try:
+        abiertas = pd.read_sql_query(
+            """
+            SELECT Activo, SUM(Cantidad) AS Cantidad,
+                   SUM(Cantidad * Precio) AS Costo_Total
+            FROM lotes GROUP BY Activo
+        """,
+            conn,
+        )
+        realizado = pd.read_sql_query(
+            """
+            SELECT Activo, SUM(Resultado) AS Resultado_Realizado
+            FROM movimientos GROUP BY Activo
+        """,
+            conn,
         )
+    finally:
+        conn.close()
+
+    posiciones = abiertas.merge(realizado, on="Activo", how="outer").fillna(0.0)
+    posiciones["Precio_Promedio"] = (
+        posiciones["Costo_Total"] / posiciones["Cantidad"].replace(0, np.nan)
+    ).fillna(0.0)
+    return posiciones[
+        ["Activo", "Cantidad", "Precio_Promedio", "Costo_Total", "Resultado_Realizado"]
+    ]
+
+
+# ============================================================
+# COTIZACIONES EN SEGUNDO PLANO
+# ============================================================
+# Archivo JSON local o URL que devuelva {"BTC": 65000, "USD": 1050, ...}
+FUENTE_COTIZACIONES = os.environ.get("TAP_FUENTE_COTIZACIONES", "cotizaciones.json")
+INTERVALO_COTIZACIONES = 15  # segundos entre consultas a la fuente
+TTL_COTIZACIONES = 120  # segundos que una cotización se considera vigente
+
+
+def fuente_archivo(ruta):
+    """Fuente de precios leída de un JSON local"""
+
+    def leer():
+        with open(ruta, encoding="utf-8") as f:
+            return json.load(f)
+
+    return leer
+
+
+def fuente_http(url, timeout=5):
+    """Fuente de precios leída de un endpoint HTTP que responde JSON"""
+
+    def leer():
+        with urllib.request.urlopen(url, timeout=timeout) as respuesta:
+            return json.load(respuesta)
+
+    return leer
+
+
+def crear_fuente(origen):
+    if origen.startswith(("http://", "https://")):
+        return fuente_http(origen)
+    return fuente_archivo(origen)
+
+
+class ServicioCotizaciones:
+    """Consulta la fuente en un loop asyncio propio y guarda las últimas cotizaciones"""
+
+    def __init__(self, fuente, intervalo=INTERVALO_COTIZACIONES, ttl=TTL_COTIZACIONES):
+        self.fuente = fuente
+        self.intervalo = intervalo
+        self.ttl = ttl
+        self._cotizaciones = {}  # simbolo -> (precio, timestamp)
+        self._lock = threading.Lock()
+        self._hilo = threading.Thread(
+            target=asyncio.run, args=(self._consultar(),), daemon=True
+        )
+        self._hilo.start()
+
+    async def _consultar(self):
+        while True:
+            try:
+                precios = await asyncio.to_thread(self.fuente)
+                ahora = time.time()
+                with self._lock:
+                    for simbolo, precio in precios.items():
+                        self._cotizaciones[str(simbolo).upper()] = (
+                            float(precio),
+                            ahora,
+                        )
+            except Exception:
+                # Se reintenta en la próxima vuelta; lo viejo vence por TTL
+                pass
+            await asyncio.sleep(self.intervalo)
+
+    def vigentes(self):
+        """Serie simbolo -> precio con las cotizaciones dentro del TTL"""
+        limite = time.time() - self.ttl
+        with self._lock:
+            return pd.Series(
+                {s: p for s, (p, t) in self._cotizaciones.items() if t >= limite},
+                dtype=float,
+            )
+
+
+@st.cache_resource
+def servicio_cotizaciones():
+    """Un único servicio por proceso, compartido por todas las sesiones"""
+    return ServicioCotizaciones(crear_fuente(FUENTE_COTIZACIONES))
+
+
+def cotizacion_usd_vigente():
+    """Cotización USD del servicio si está vigente; si no, la cargada a mano"""
+    cotizaciones = servicio_cotizaciones().vigentes()
+    return float(cotizaciones.get("USD", st.session_state.cotizacion_usd))
+
+
+def valuar_a_mercado(posiciones, cotizaciones):
+    """Valuación vectorizada de las posiciones con las cotizaciones vigentes"""
+    valuadas = posiciones.copy()
+    valuadas["Precio_Actual"] = valuadas["Activo"].map(cotizaciones)
+    valuadas["Valor_Mercado"] = valuadas["Cantidad"] * valuadas["Precio_Actual"]
+    valuadas["Resultado_No_Realizado"] = (
+        valuadas["Valor_Mercado"] - valuadas["Costo_Total"]
+    )
+    return valuadas
+
+
+# ============================================================
+# MULTIMONEDA
+# ============================================================
+# Sin tipo de cambio propio, estas monedas se valúan como su equivalente
+MONEDAS_EQUIVALENTES = {
+    "USD MEP": "USD",
+    "USD CCL": "USD",
+    "USDT": "USD",
+    "USDC": "USD",
+    "DAI": "USD",
+}
+
+
+def leer_tipos_cambio():
+    """Último valor en ARS cargado para cada moneda"""
+    conn = sqlite3.connect("trade_analytics.db")
+    try:
+        # En SQLite las columnas sueltas salen de la fila con MAX(fecha)
+        tipos = pd.read_sql_query(
+            "SELECT moneda, valor_ars, MAX(fecha) FROM tipos_cambio GROUP BY moneda",
+            conn,
+        )
+        return tipos.set_index("moneda")["valor_ars"]
     except:
-        st.session_state.cotizacion_usd = 1000.0
+        return pd.Series(dtype=float)
+    finally:
+        conn.close()
+
+
+def valores_en_ars():
+    """Valor en ARS de una unidad de cada moneda conocida (NaN si no hay dato)"""
+    valores = pd.Series(np.nan, index=MONEDAS)
+    cargados = cache_tablas().obtener("tipos_cambio", leer_tipos_cambio)
+    valores.update(cargados.reindex(valores.index))
+    # Las cotizaciones en vivo, si traen la moneda, tienen prioridad
+    valores.update(servicio_cotizaciones().vigentes().reindex(valores.index))
+    valores["ARS"] = 1.0
+    valores["USD"] = cotizacion_usd_vigente()
+    for moneda, equivalente in MONEDAS_EQUIVALENTES.items():
+        if pd.isna(valores[moneda]):
+            valores[moneda] = valores[equivalente]
+    return valores
+
+
+def matriz_cambio():
+    """Matriz origen x destino: unidades de destino por cada unidad de origen"""
+    valores = valores_en_ars()
+    return pd.DataFrame(
+        np.outer(valores, 1 / valores), index=valores.index, columns=valores.index
+    )
 
-    conn.commit()
-    conn.close()
 
+def convertir_montos(montos, monedas, destino, matriz):
+    """Conversión vectorizada: una búsqueda en la matriz y una multiplicación"""
+    factores = matriz[destino].reindex(monedas.astype(str)).to_numpy()
+    return montos.to_numpy() * factores
 
-# Inicializar la aplicación
-if "portafolio" not in st.session_state:
-    st.session_state.portafolio = pd.DataFrame(
-        columns=["Tipo_Activo", "Broker", "Monto_Invertido", "Moneda", "Renta"]
-    )
-
-if "libro_trading" not in st.session_state:
-    st.session_state.libro_trading = pd.DataFrame(
-        columns=[
-            "Fecha_Entrada",
-            "Fecha_Salida",
-            "Activo",
-            "Operacion",
-            "Cantidad",
-            "Precio_Entrada",
-            "Precio_Salida",
-            "Inversion_Total",
-            "Resultado",
-            "ROI",
-            "Duracion",
-            "Estrategia",
-            "Notas",
-        ]
+
+def monedas_sin_cotizacion(monedas, destino, matriz):
+    """Monedas presentes que no se pueden llevar a la moneda destino"""
+    return sorted(
+        set(pd.Series(monedas).dropna().astype(str))
+        & set(matriz.index[matriz[destino].isna()])
     )
 
-if "cotizacion_usd" not in st.session_state:
-    st.session_state.cotizacion_usd = 1000.0
 
-# Inicializar base de datos
+def total_en_moneda(por_moneda, destino, matriz):
+    """Suma una serie indexada por moneda convertida a la moneda destino"""
+    return float(
+        np.nansum(
+            convertir_montos(por_moneda, por_moneda.index.to_series(), destino, matriz)
+        )
+    )
+
+
+# ============================================================
+# SNAPSHOTS DIARIOS DEL PORTAFOLIO
+# ============================================================
+DIMENSIONES_SNAPSHOT = {
+    "Total": None,
+    "Tipo de Activo": "Tipo_Activo",
+    "Broker": "Broker",
+}
+FRECUENCIAS_SNAPSHOT = {"Diaria": "D", "Semanal": "W", "Mensual": "ME"}
+
+
+def actualizar_snapshots(portafolio_ars, forzar=False):
+    """Completa los días faltantes desde el último snapshot y registra el de hoy.
+
+    Devuelve las monedas sin tipo de cambio a ARS: con alguna, no se guarda nada
+    (un total parcial se arrastraría a todos los días sin snapshot).
+    """
+    faltantes = monedas_sin_cotizacion(portafolio_ars["Moneda"], "ARS", matriz_cambio())
+    if faltantes:
+        return faltantes
+    hoy = datetime.now().date()
+    conn = sqlite3.connect("trade_analytics.db")
+    try:
+        ultima = conn.execute(
+            "SELECT MAX(Fecha) FROM snapshots WHERE Dimension = 'Total'"
+        ).fetchone()[0]
+        if ultima == hoy.isoformat() and not forzar:
+            # Otra sesión ya lo tomó: esta no vuelve a consultar hasta mañana
+            st.session_state.snapshot_fecha = hoy.isoformat()
+            return []
+
+        if ultima is not None and ultima < hoy.isoformat():
+            # Sin guardados intermedios el portafolio no cambió: se arrastra el último
+            previos = conn.execute(
+                "SELECT Dimension, Categoria, Valor_ARS FROM snapshots WHERE Fecha = ?",
+                (ultima,),
+            ).fetchall()
+            dias = pd.date_range(
+                pd.Timestamp(ultima) + timedelta(days=1), hoy - timedelta(days=1)
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO snapshots "
+                "(Fecha, Dimension, Categoria, Valor_ARS) VALUES (?, ?, ?, ?)",
+                [
+                    (dia.date().isoformat(), *previo)
+                    for dia in dias
+                    for previo in previos
+                ],
+            )
+
+        filas = [("Total", "Total", float(portafolio_ars["Monto_ARS"].sum()))]
+        for dimension in ["Tipo_Activo", "Broker"]:
+            valores = portafolio_ars.groupby(dimension, observed=True)[
+                "Monto_ARS"
+            ].sum()
+            filas += [(dimension, str(k), float(v)) for k, v in valores.items()]
+
+        conn.execute("DELETE FROM snapshots WHERE Fecha = ?", (hoy.isoformat(),))
+        conn.executemany(
+            "INSERT INTO snapshots (Fecha, Dimension, Categoria, Valor_ARS) "
+            "VALUES (?, ?, ?, ?)",
+            [(hoy.isoformat(), *fila) for fila in filas],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    st.session_state.snapshot_fecha = hoy.isoformat()
+    return []
+
+
+def cargar_snapshots(dimension, desde, hasta):
+    """Serie temporal (Fecha x Categoría) con una sola consulta por rango indexado"""
+    conn = sqlite3.connect("trade_analytics.db")
+    try:
+        snapshots = pd.read_sql_query(
+            "SELECT Fecha, Categoria, Valor_ARS FROM snapshots "
+            "WHERE Dimension = ? AND Fecha BETWEEN ? AND ?",
+            conn,
+            params=(dimension, str(desde), str(hasta)),
+            parse_dates=["Fecha"],
+        )
+    finally:
+        conn.close()
+    return snapshots.pivot_table(
+        index="Fecha", columns="Categoria", values="Valor_ARS", aggfunc="sum"
+    ).fillna(0.0)
+
+
+def evolucion_portafolio():
+    st.subheader("📅 Evolución del Portafolio")
+    col_dim, col_frec, col_rango = st.columns(3)
+    with col_dim:
+        etiqueta = st.selectbox(
+            "Agrupar por", list(DIMENSIONES_SNAPSHOT), key="snap_dimension"
+        )
+    with col_frec:
+        frecuencia = st.selectbox(
+            "Frecuencia", list(FRECUENCIAS_SNAPSHOT), key="snap_frecuencia"
+        )
+    with col_rango:
+        hoy = datetime.now().date()
+        rango = st.date_input(
+            "Rango", (hoy - timedelta(days=365), hoy), key="snap_rango"
+        )
+    if len(rango) != 2:
+        return
+
+    serie = cargar_snapshots(
+        DIMENSIONES_SNAPSHOT[etiqueta] or "Total", rango[0], rango[1]
+    )
+    if serie.empty:
+        st.info("📝 Todavía no hay snapshots en el rango elegido")
+        return
+    # Son saldos, no flujos: al reagrupar se toma el último valor de cada período
+    serie = serie.resample(FRECUENCIAS_SNAPSHOT[frecuencia]).last().dropna(how="all")
+
+    if st.session_state.graficos_interactivos:
+        st.line_chart(serie, y_label="Valor en ARS")
+    else:
+        fig, ax = plt.subplots(figsize=(12, 5))
+        for i, columna in enumerate(serie.columns):
+            ax.plot(
+                serie.index,
+                serie[columna],
+                linewidth=2,
+                color=COLORES_GRAFICOS[i % len(COLORES_GRAFICOS)],
+                label=columna,
+            )
+        ax.set_ylabel("Valor en ARS")
+        ax.legend()
+        ax.grid(True, alpha=0.2, linestyle="--")
+        ax.set_facecolor("#f8f9fa")
+        plt.xticks(rotation=45)
+        plt.tight_layout()
+        st.pyplot(fig)
+
+
+# Inicializar la aplicación
+if "graficos_interactivos" not in st.session_state:
+    st.session_state.graficos_interactivos = False
+if "moneda_reporte" not in st.session_state:
+    st.session_state.moneda_reporte = "ARS"
+
+# Inicializar base de datos y tomar las tablas de la caché compartida
 init_db()
+archivo_automatico()
+cargar_tablas()
 
 # ============================================================
 # LOGO + INFO PRINCIPAL
@@ -314,22 +1476,36 @@ with col_info:
         """,
             unsafe_allow_html=True,
         )
+    st.toggle(
+        "⚡ Gráficos interactivos",
+        key="graficos_interactivos",
+        help="Dibuja los gráficos en el navegador (zoom y tooltips) en lugar de imágenes",
+    )
+    # Solo se puede reportar en monedas con tipo de cambio cargado
+    monedas_reporte = list(valores_en_ars().dropna().index)
+    if st.session_state.moneda_reporte not in monedas_reporte:
+        st.caption(
+            f"⚠️ {st.session_state.moneda_reporte} ya no tiene tipo de cambio: "
+            "se reporta en ARS"
+        )
+        st.session_state.moneda_reporte = "ARS"
+    st.selectbox("🌐 Moneda de reporte", monedas_reporte, key="moneda_reporte")
 
 with col_logo:
     if not st.session_state.portafolio.empty:
-        portafolio_copy = st.session_state.portafolio.copy()
-        portafolio_copy["Monto_Invertido"] = portafolio_copy["Monto_Invertido"].apply(
-            convertir_a_numero
-        )
-        portafolio_copy["Monto_ARS"] = portafolio_copy.apply(
-            lambda x: (
-                x["Monto_Invertido"] * st.session_state.cotizacion_usd
-                if x["Moneda"] in ["USD", "USDT"]
-                else x["Monto_Invertido"]
-            ),
-            axis=1,
+        matriz = matriz_cambio()
+        portafolio_copy = calcular_portafolio_ars(
+            st.session_state.portafolio, matriz, st.session_state.moneda_reporte
         )
-        total_invertido_ars = portafolio_copy["Monto_ARS"].sum()
+        total_invertido = portafolio_copy["Monto_Reporte"].sum()
+        sin_cotizacion = monedas_sin_cotizacion(
+            portafolio_copy["Moneda"], st.session_state.moneda_reporte, matriz
+        )
+
+        # Snapshot diario: solo en la primera ejecución del día de cada sesión
+        if st.session_state.get("snapshot_fecha") != datetime.now().date().isoformat():
+            if actualizar_snapshots(portafolio_copy):
+                st.caption("⚠️ Snapshot de hoy pendiente: faltan tipos de cambio a ARS")
 
         st.markdown(
             f"""
@@ -340,7 +1516,7 @@ with col_logo:
                     💰 INVERSIÓN TOTAL
                 </h3>
                 <p style="font-size: 1.8rem; font-weight: bold; color: #0047ab; margin: 5px 0;">
-                    {format_currency(total_invertido_ars)}
+                    {format_currency(total_invertido, st.session_state.moneda_reporte)}
                 </p>
                 <p style="color: #2c3e50; margin: 0; font-size: 0.9rem;">
                     {len(st.session_state.portafolio)} activos en cartera
@@ -349,6 +1525,11 @@ with col_logo:
         """,
             unsafe_allow_html=True,
         )
+        if sin_cotizacion:
+            st.caption(
+                f"⚠️ Sin tipo de cambio para {', '.join(sin_cotizacion)}: "
+                "el total no los incluye"
+            )
     else:
         st.markdown(
             """
@@ -366,11 +1547,11 @@ with col_logo:
 
 st.markdown("---")
 
-# Pestañas principales
-tab1, tab2, tab3 = st.tabs(["💼 Portafolio", "📈 Trading", "🎯 TP/SL Calculator"])
 
 # Pestaña 1: Portafolio de Inversiones
-with tab1:
+@st.fragment
+def seccion_portafolio():
+    tablas_al_dia()
     st.header("💼 Portafolio de Inversiones")
 
     col1, col2 = st.columns([3, 1])
@@ -378,6 +1559,8 @@ with tab1:
     with col2:
         st.markdown('<div class="dolar-box-premium">', unsafe_allow_html=True)
         st.markdown("**💵 Cotización USD**")
+        if "USD" in servicio_cotizaciones().vigentes():
+            st.caption(f"🟢 En vivo: {format_currency(cotizacion_usd_vigente())}")
         nueva_cotizacion = st.number_input(
             "Valor USD → ARS",
             min_value=1.0,
@@ -395,9 +1578,58 @@ with tab1:
             )
             conn.commit()
             conn.close()
+            cache_tablas().invalidar()
+            if not st.session_state.portafolio.empty:
+                actualizar_snapshots(
+                    calcular_portafolio_ars(
+                        st.session_state.portafolio, matriz_cambio()
+                    ),
+                    forzar=True,
+                )
             st.success("✅ Cotización actualizada!")
+            # El encabezado vive fuera del fragmento: refrescar toda la app
+            st.rerun()
         st.markdown("</div>", unsafe_allow_html=True)
 
+        with st.expander("💱 Otras monedas"):
+            valores = valores_en_ars()
+            st.dataframe(
+                valores.rename("ARS por unidad").to_frame(),
+                use_container_width=True,
+            )
+            moneda_tc = st.selectbox(
+                "Moneda",
+                [m for m in MONEDAS if m not in ("ARS", "USD")],
+                key="moneda_tipo_cambio",
+            )
+            st.text("VALOR EN ARS:")
+            valor_tc = st.number_input(
+                "Valor en ARS",
+                min_value=0.0001,
+                value=float(valores[moneda_tc]) if valores[moneda_tc] > 0 else 1.0,
+                step=1.0,
+                label_visibility="collapsed",
+                key="valor_tipo_cambio",
+            )
+            if st.button("💾 Guardar tipo de cambio", use_container_width=True):
+                conn = sqlite3.connect("trade_analytics.db")
+                conn.execute(
+                    "INSERT INTO tipos_cambio (fecha, moneda, valor_ars) VALUES (?, ?, ?)",
+                    (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), moneda_tc, valor_tc),
+                )
+                conn.commit()
+                conn.close()
+                cache_tablas().invalidar()
+                if not st.session_state.portafolio.empty:
+                    actualizar_snapshots(
+                        calcular_portafolio_ars(
+                            st.session_state.portafolio, matriz_cambio()
+                        ),
+                        forzar=True,
+                    )
+                st.success(f"✅ {moneda_tc} actualizado!")
+                st.rerun()
+
     with col1:
         st.info("💡 Agregá tus activos de inversión a largo plazo")
 
@@ -408,18 +1640,7 @@ with tab1:
         column_config={
             "Tipo_Activo": st.column_config.SelectboxColumn(
                 "Tipo de Activo",
-                options=[
-                    "CEDEARs",
-                    "Acciones",
-                    "Bonos",
-                    "Fondos",
-                    "Cripto",
-                    "Letras",
-                    "ONs",
-                    "Otros",
-                    "Causión",
-                    "Dolar",
-                ],
+                options=TIPOS_ACTIVO,
                 required=True,
             ),
             "Broker": st.column_config.SelectboxColumn(
@@ -429,10 +1650,10 @@ with tab1:
                 "Monto Invertido", format="%.0f", required=True, min_value=0
             ),
             "Moneda": st.column_config.SelectboxColumn(
-                "Moneda", options=["ARS", "USD", "USDT"], required=True
+                "Moneda", options=MONEDAS, required=True
             ),
             "Renta": st.column_config.SelectboxColumn(
-                "Tipo de Renta", options=["Variable", "Fija", "Mixta"], required=True
+                "Tipo de Renta", options=TIPOS_RENTA, required=True
             ),
         },
     )
@@ -447,14 +1668,21 @@ with tab1:
         montos_validos = all(portafolio_validado["Monto_Invertido"] > 0)
 
         if montos_validos and not portafolio_validado.empty:
-            st.session_state.portafolio = portafolio_validado
+            portafolio_validado = aplicar_esquema(
+                portafolio_validado, ESQUEMA_PORTAFOLIO
+            )
             conn = sqlite3.connect("trade_analytics.db")
             conn.execute("DELETE FROM portafolio")
-            st.session_state.portafolio.to_sql(
+            portafolio_validado.to_sql(
                 "portafolio", conn, if_exists="append", index=False
             )
             conn.commit()
             conn.close()
+            cache_tablas().invalidar()
+            actualizar_snapshots(
+                calcular_portafolio_ars(portafolio_validado, matriz_cambio()),
+                forzar=True,
+            )
             st.success("✅ Portafolio guardado correctamente!")
             st.rerun()
         else:
@@ -462,76 +1690,81 @@ with tab1:
 
     if not st.session_state.portafolio.empty:
         st.divider()
-        portafolio_copy = st.session_state.portafolio.copy()
-        portafolio_copy["Monto_Invertido"] = portafolio_copy["Monto_Invertido"].apply(
-            convertir_a_numero
-        )
-        portafolio_copy["Monto_ARS"] = portafolio_copy.apply(
-            lambda x: (
-                x["Monto_Invertido"] * st.session_state.cotizacion_usd
-                if x["Moneda"] in ["USD", "USDT"]
-                else x["Monto_Invertido"]
-            ),
-            axis=1,
+        moneda = st.session_state.moneda_reporte
+        matriz = matriz_cambio()
+        portafolio_copy = calcular_portafolio_ars(
+            st.session_state.portafolio, matriz, moneda
+        )
+        total_invertido = portafolio_copy["Monto_Reporte"].sum()
+
+        sin_cotizacion = monedas_sin_cotizacion(
+            portafolio_copy["Moneda"], moneda, matriz
         )
-        total_invertido_ars = portafolio_copy["Monto_ARS"].sum()
+        if sin_cotizacion:
+            st.caption(
+                f"⚠️ Sin tipo de cambio para {', '.join(sin_cotizacion)}: "
+                "esos montos no se suman"
+            )
 
         col_graph, col_table = st.columns(2)
 
         with col_graph:
             st.subheader("📈 Distribución por Tipo de Activo")
             if not portafolio_copy.empty:
-                distribucion_activos = portafolio_copy.groupby("Tipo_Activo")[
-                    "Monto_ARS"
-                ].sum()
-                if not distribucion_activos.empty:
-                    fig, ax = plt.subplots(figsize=(8, 8))
-                    colors = [
-                        "#1a2a6c",
-                        "#0047ab",
-                        "#0066cc",
-                        "#0088cc",
-                        "#00aacc",
-                        "#00ccdd",
-                    ]
-                    wedges, texts, autotexts = ax.pie(
-                        distribucion_activos.values,
-                        labels=distribucion_activos.index,
-                        autopct="%1.1f%%",
-                        startangle=90,
-                        colors=colors,
-                        shadow=True,
-                        explode=[0.03] * len(distribucion_activos),
-                    )
-                    for autotext in autotexts:
-                        autotext.set_color("white")
-                        autotext.set_fontweight("bold")
-                        autotext.set_fontsize(9)
-                    for text in texts:
-                        text.set_fontsize(10)
-                    ax.set_title(
-                        "Distribución por Tipo de Activo",
-                        fontsize=14,
-                        fontweight="bold",
-                    )
-                    ax.axis("equal")
-                    ax.grid(True, alpha=0.2, linestyle="--")
-                    st.pyplot(fig)
+                distribucion_activos = portafolio_copy.groupby(
+                    "Tipo_Activo", observed=True
+                )["Monto_Reporte"].sum()
+                # Sin montos convertibles no hay torta que dibujar
+                if distribucion_activos.sum() > 0:
+                    if st.session_state.graficos_interactivos:
+                        st.altair_chart(
+                            grafico_torta_altair(
+                                distribucion_activos,
+                                "Tipo_Activo",
+                                "Distribución por Tipo de Activo",
+                            ),
+                            use_container_width=True,
+                        )
+                    else:
+                        fig, ax = plt.subplots(figsize=(8, 8))
+                        wedges, texts, autotexts = ax.pie(
+                            distribucion_activos.values,
+                            labels=distribucion_activos.index,
+                            autopct="%1.1f%%",
+                            startangle=90,
+                            colors=COLORES_GRAFICOS,
+                            shadow=True,
+                            explode=[0.03] * len(distribucion_activos),
+                        )
+                        for autotext in autotexts:
+                            autotext.set_color("white")
+                            autotext.set_fontweight("bold")
+                            autotext.set_fontsize(9)
+                        for text in texts:
+                            text.set_fontsize(10)
+                        ax.set_title(
+                            "Distribución por Tipo de Activo",
+                            fontsize=14,
+                            fontweight="bold",
+                        )
+                        ax.axis("equal")
+                        ax.grid(True, alpha=0.2, linestyle="--")
+                        st.pyplot(fig)
 
         with col_table:
             st.subheader("🏢 Distribución por Broker")
             if not portafolio_copy.empty:
-                distribucion_broker = portafolio_copy.groupby("Broker")[
-                    "Monto_ARS"
+                distribucion_broker = portafolio_copy.groupby("Broker", observed=True)[
+                    "Monto_Reporte"
                 ].sum()
                 if not distribucion_broker.empty:
                     broker_data = []
                     for broker, monto in distribucion_broker.items():
-                        porcentaje = (monto / total_invertido_ars) * 100
+                        porcentaje = (monto / total_invertido) * 100
                         broker_data.append(
                             {
                                 "Broker": broker,
-                                "Monto": format_currency(monto),
+                                "Monto": format_currency(monto, moneda),
                                 "Porcentaje": f"{porcentaje:.1f}%",
                             }
                         )
@@ -540,150 +1773,245 @@ with tab1:
                         broker_df,
                         column_config={
                             "Broker": "Broker",
-                            "Monto": st.column_config.TextColumn("Monto en ARS"),
+                            "Monto": st.column_config.TextColumn(f"Monto en {moneda}"),
                             "Porcentaje": st.column_config.TextColumn("Porcentaje"),
                         },
                         hide_index=True,
                         use_container_width=True,
                     )
+                    if st.session_state.graficos_interactivos:
+                        st.altair_chart(
+                            grafico_barras_altair(
+                                distribucion_broker,
+                                "Broker",
+                                "Monto por Broker",
+                                f"Monto en {moneda}",
+                            ),
+                            use_container_width=True,
+                        )
 
-# Pestaña 2: Libro de Trading - SUPER CLARO
-with tab2:
-    st.header("📈 Libro de Trading")
-    st.info("Registro de operaciones COMPLETAS (compra + venta)")
-
-    col1, col2 = st.columns([1, 2])
+        st.divider()
+        evolucion_portafolio()
 
-    with col1:
-        st.subheader("🆕 Nueva Operación")
-
-        with st.form("operacion_completa"):
-            # Fechas
-            col_fecha1, col_fecha2 = st.columns(2)
-            with col_fecha1:
-                fecha_compra = st.date_input("FECHA ENTRADA", datetime.now())
-            with col_fecha2:
-                fecha_venta = st.date_input("FECHA SALIDA", datetime.now())
-
-            # Validación de fechas
-            if fecha_venta < fecha_compra:
-                st.error("❌ La fecha de venta no puede ser anterior a la compra")
-
-            # Activo y Operación
-            col_activo, col_operacion = st.columns(2)
-            with col_activo:
-                activo = st.text_input(
-                    "ACTIVO", "BTC", help="Símbolo del activo (BTC, AAPL, etc)"
-                )
-            with col_operacion:
-                operacion = st.selectbox("OPERACIÓN", ["COMPRA", "VENTA"])
 
-            # Precios y Cantidad
-            st.text("PRECIO COMPRA:")
-            precio_compra = st.number_input(
-                "",
-                min_value=0.0,
-                value=900.0,
-                step=1.0,
-                format="%.0f",
-                key="precio_compra",
-                help="Precio por unidad al momento de la compra",
+# Pestaña 2: Libro de Trading - SUPER CLARO
+@st.fragment
+def formulario_nueva_operacion():
+    st.subheader("🆕 Nueva Operación")
+
+    with st.form("operacion_completa"):
+        # Fechas
+        col_fecha1, col_fecha2 = st.columns(2)
+        with col_fecha1:
+            fecha_compra = st.date_input("FECHA ENTRADA", datetime.now())
+        with col_fecha2:
+            fecha_venta = st.date_input("FECHA SALIDA", datetime.now())
+
+        # Validación de fechas
+        if fecha_venta < fecha_compra:
+            st.error("❌ La fecha de venta no puede ser anterior a la compra")
+
+        # Activo y Operación
+        col_activo, col_operacion = st.columns(2)
+        with col_activo:
+            activo = st.text_input(
+                "ACTIVO", "BTC", help="Símbolo del activo (BTC, AAPL, etc)"
             )
+        with col_operacion:
+            operacion = st.selectbox("OPERACIÓN", OPERACIONES)
+        moneda = st.selectbox("MONEDA", MONEDAS, help="Moneda de los precios")
 
-            st.text("CANTIDAD:")
-            cantidad = st.number_input(
-                "",
-                min_value=0.0,
-                value=1.594,
-                step=0.001,
-                format="%.3f",
-                key="cantidad",
-                help="Número de unidades compradas",
-            )
+        # Precios y Cantidad
+        st.text("PRECIO COMPRA:")
+        precio_compra = st.number_input(
+            "",
+            min_value=0.0,
+            value=900.0,
+            step=1.0,
+            format="%.0f",
+            key="precio_compra",
+            help="Precio por unidad al momento de la compra",
+        )
 
-            st.text("PRECIO VENTA:")
-            precio_venta = st.number_input(
-                "",
-                min_value=0.0,
-                value=1000.0,
-                step=1.0,
-                format="%.0f",
-                key="precio_venta",
-                help="Precio por unidad al momento de la venta",
-            )
+        st.text("CANTIDAD:")
+        cantidad = st.number_input(
+            "",
+            min_value=0.0,
+            value=1.594,
+            step=0.001,
+            format="%.3f",
+            key="cantidad",
+            help="Número de unidades compradas",
+        )
 
-            # Cálculos automáticos
-            inversion_total = precio_compra * cantidad
-            resultado = (precio_venta - precio_compra) * cantidad
-            roi = (resultado / inversion_total * 100) if inversion_total > 0 else 0
-            duracion = (fecha_venta - fecha_compra).days
+        st.text("PRECIO VENTA:")
+        precio_venta = st.number_input(
+            "",
+            min_value=0.0,
+            value=1000.0,
+            step=1.0,
+            format="%.0f",
+            key="precio_venta",
+            help="Precio por unidad al momento de la venta",
+        )
 
-            # Mostrar resultados
-            st.markdown("---")
-            col_res1, col_res2 = st.columns(2)
-            with col_res1:
-                st.metric("Total operación", format_currency(inversion_total))
-            with col_res2:
-                color = "green" if resultado >= 0 else "red"
-                st.metric("Resultado", format_currency(resultado))
+        # Cálculos automáticos
+        inversion_total = precio_compra * cantidad
+        resultado = (precio_venta - precio_compra) * cantidad
+        roi = (resultado / inversion_total * 100) if inversion_total > 0 else 0
+        duracion = (fecha_venta - fecha_compra).days
 
-            st.metric("ROI", f"{roi:.1f}%")
+        # Mostrar resultados
+        st.markdown("---")
+        col_res1, col_res2 = st.columns(2)
+        with col_res1:
+            st.metric("Total operación", format_currency(inversion_total, moneda))
+        with col_res2:
+            color = "green" if resultado >= 0 else "red"
+            st.metric("Resultado", format_currency(resultado, moneda))
+
+        st.metric("ROI", f"{roi:.1f}%")
+
+        # Estrategia
+        estrategia = st.selectbox("ESTRATEGIA", ESTRATEGIAS)
+        notas = st.text_area("NOTAS")
+
+        submitted = st.form_submit_button("💾 GUARDAR OPERACIÓN")
+
+        if submitted and fecha_venta >= fecha_compra:
+            if activo and cantidad > 0 and precio_compra > 0 and precio_venta > 0:
+                nueva_operacion = pd.DataFrame(
+                    [
+                        {
+                            "Fecha_Entrada": fecha_compra,
+                            "Fecha_Salida": fecha_venta,
+                            "Activo": activo.upper(),
+                            "Operacion": operacion,
+                            "Cantidad": cantidad,
+                            "Precio_Entrada": precio_compra,
+                            "Precio_Salida": precio_venta,
+                            "Inversion_Total": inversion_total,
+                            "Resultado": resultado,
+                            "ROI": roi,
+                            "Duracion": duracion,
+                            "Estrategia": estrategia,
+                            "Notas": notas,
+                            "Moneda": moneda,
+                        }
+                    ]
+                )
 
-            # Estrategia
-            estrategia = st.selectbox(
-                "ESTRATEGIA", ["ANÁLISIS TÉCNICO", "ANÁLISIS FUNDAMENTAL", "MIXTA"]
-            )
-            notas = st.text_area("NOTAS")
+                conn = sqlite3.connect("trade_analytics.db")
+                nueva_operacion.to_sql(
+                    "operaciones", conn, if_exists="append", index=False
+                )
+                conn.commit()
+                conn.close()
+                cache_tablas().invalidar()
+                st.success("✅ Operación registrada correctamente!")
+                st.rerun()
+            else:
+                st.error("❌ Complete todos los campos")
 
-            submitted = st.form_submit_button("💾 GUARDAR OPERACIÓN")
 
-            if submitted and fecha_venta >= fecha_compra:
-                if activo and cantidad > 0 and precio_compra > 0 and precio_venta > 0:
-                    nueva_operacion = pd.DataFrame(
-                        [
-                            {
-                                "Fecha_Entrada": fecha_compra,
-                                "Fecha_Salida": fecha_venta,
-                                "Activo": activo.upper(),
-                                "Operacion": operacion,
-                                "Cantidad": cantidad,
-                                "Precio_Entrada": precio_compra,
-                                "Precio_Salida": precio_venta,
-                                "Inversion_Total": inversion_total,
-                                "Resultado": resultado,
-                                "ROI": roi,
-                                "Duracion": duracion,
-                                "Estrategia": estrategia,
-                                "Notas": notas,
-                            }
-                        ]
-                    )
+LIMITE_HISTORIAL = 200  # operaciones que se muestran como expanders
 
-                    st.session_state.libro_trading = pd.concat(
-                        [st.session_state.libro_trading, nueva_operacion],
-                        ignore_index=True,
-                    )
-                    conn = sqlite3.connect("trade_analytics.db")
-                    nueva_operacion.to_sql(
-                        "operaciones", conn, if_exists="append", index=False
-                    )
-                    conn.commit()
-                    conn.close()
-                    st.success("✅ Operación registrada correctamente!")
-                    st.rerun()
-                else:
-                    st.error("❌ Complete todos los campos")
 
-    with col2:
-        st.subheader("📋 Historial de Operaciones")
-        if not st.session_state.libro_trading.empty:
-            # Gráfico MEJORADO
-            st.subheader("📊 Evolución del Capital")
-            df_evolucion = st.session_state.libro_trading.copy()
-            df_evolucion["Fecha"] = pd.to_datetime(df_evolucion["Fecha_Entrada"])
-            df_evolucion = df_evolucion.sort_values("Fecha")
-            df_evolucion["Acumulado_Total"] = df_evolucion["Resultado"].cumsum()
+def filtros_busqueda():
+    """Barra de búsqueda del historial; devuelve solo los filtros activos"""
+    with st.expander("🔎 Buscar y filtrar", expanded=False):
+        texto = st.text_input(
+            "Buscar en notas", key="busq_texto", placeholder="ej: ruptura soporte"
+        )
+        col_a, col_b, col_c = st.columns(3)
+        with col_a:
+            activos = st.multiselect(
+                "Activo",
+                activos_historicos(),
+                key="busq_activos",
+            )
+        with col_b:
+            estrategias = st.multiselect(
+                "Estrategia", ESTRATEGIAS, key="busq_estrategias"
+            )
+        with col_c:
+            operaciones = st.multiselect(
+                "Operación", OPERACIONES, key="busq_operaciones"
+            )
+        col_d, col_e, col_f = st.columns(3)
+        with col_d:
+            rango = st.date_input("Fecha de entrada", (), key="busq_rango")
+        with col_e:
+            st.text(f"RESULTADO MÍNIMO ({st.session_state.moneda_reporte}):")
+            resultado_min = st.number_input(
+                "Resultado mínimo", value=None, step=100.0, key="busq_resultado"
+            )
+        with col_f:
+            st.text("ROI MÍNIMO (%):")
+            roi_min = st.number_input(
+                "ROI mínimo (%)", value=None, step=1.0, key="busq_roi"
+            )
+
+    filtros = {
+        "texto": texto.strip(),
+        "activos": tuple(activos),
+        "estrategias": tuple(estrategias),
+        "operaciones": tuple(operaciones),
+        "desde": rango[0] if len(rango) >= 1 else None,
+        "hasta": rango[1] if len(rango) == 2 else None,
+        "resultado_min": resultado_min,
+        "roi_min": roi_min,
+    }
+    filtros = {k: v for k, v in filtros.items() if v not in (None, "", ())}
+    if resultado_min is not None:
+        filtros["moneda_resultado"] = st.session_state.moneda_reporte
+    return filtros
+
+
+@st.fragment
+def historial_operaciones():
+    tablas_al_dia()
+    st.subheader("📋 Historial de Operaciones")
+
+    filtros = filtros_busqueda()
+    if filtros:
+        # Búsqueda en la base: estadísticas y curva solo del subconjunto
+        libro = buscar_operaciones(**filtros)
+        st.caption(f"🔎 {len(libro)} operaciones coinciden con la búsqueda")
+        hay_operaciones = not libro.empty
+    else:
+        libro = st.session_state.libro_trading
+        # La tabla caliente puede estar vacía con todo el historial archivado
+        hay_operaciones = estadisticas_libro()["total_ops"] > 0
+
+    if hay_operaciones:
+        # Resultados de cada moneda llevados a la moneda de reporte
+        moneda = st.session_state.moneda_reporte
+        matriz = matriz_cambio()
+        factores = matriz[moneda]
+        estadisticas = calcular_estadisticas(libro) if filtros else estadisticas_libro()
+        sin_cotizacion = monedas_sin_cotizacion(
+            estadisticas["resultado_por_moneda"].index, moneda, matriz
+        )
+        if sin_cotizacion:
+            st.caption(
+                f"⚠️ Sin tipo de cambio para {', '.join(sin_cotizacion)}: "
+                "sus resultados no entran en la curva ni en la ganancia total"
+            )
 
+        # Gráfico MEJORADO
+        st.subheader("📊 Evolución del Capital")
+        df_evolucion = (
+            calcular_evolucion_capital(calcular_acumulados(libro), factores)
+            if filtros
+            else evolucion_capital(factores)
+        )
+
+        if st.session_state.graficos_interactivos:
+            st.altair_chart(
+                grafico_evolucion_altair(df_evolucion), use_container_width=True
+            )
+        else:
             fig, ax = plt.subplots(figsize=(12, 6))
             ax.plot(
                 df_evolucion["Fecha"],
@@ -695,7 +2023,7 @@ with tab2:
                 markersize=6,
             )
             ax.set_xlabel("Fecha")
-            ax.set_ylabel("Resultado Acumulado ($)")
+            ax.set_ylabel(f"Resultado Acumulado ({moneda})")
             ax.set_title("Evolución del Capital", fontsize=14, fontweight="bold")
             ax.legend()
             ax.grid(True, alpha=0.2, linestyle="--")
@@ -704,72 +2032,248 @@ with tab2:
             plt.tight_layout()
             st.pyplot(fig)
 
-            # Operaciones individuales
-            for i, op in st.session_state.libro_trading.iterrows():
-                with st.expander(
-                    f"{op['Activo']} - {op['Operacion']} - {op['Fecha_Entrada']}"
-                ):
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.write(
-                            f"**Inversión:** {format_currency(op['Inversion_Total'])}"
-                        )
-                        st.write(f"**Cantidad:** {op['Cantidad']}")
-                        st.write(
-                            f"**Precio Compra:** {format_currency(op['Precio_Entrada'])}"
-                        )
-                        st.write(
-                            f"**Precio Venta:** {format_currency(op['Precio_Salida'])}"
-                        )
-                    with col2:
-                        color = "green" if op["Resultado"] >= 0 else "red"
-                        st.write(
-                            f"**Resultado:** :{color}[{format_currency(op['Resultado'])}]"
-                        )
-                        st.write(f"**ROI:** :{color}[{op['ROI']:.1f}%]")
-                        st.write(f"**Duración:** {op['Duracion']} días")
-                        st.write(f"**Estrategia:** {op['Estrategia']}")
+        # Operaciones individuales
+        if len(libro) > LIMITE_HISTORIAL:
+            st.caption(
+                f"Mostrando las últimas {LIMITE_HISTORIAL} de {len(libro)} operaciones"
+            )
+        for i, op in libro.tail(LIMITE_HISTORIAL).iterrows():
+            with st.expander(
+                f"{op['Activo']} - {op['Operacion']} - {op['Fecha_Entrada'].date()}"
+            ):
+                col1, col2 = st.columns(2)
+                with col1:
+                    moneda_op = op["Moneda"]
+                    st.write(
+                        f"**Inversión:** {format_currency(op['Inversion_Total'], moneda_op)}"
+                    )
+                    st.write(f"**Cantidad:** {op['Cantidad']}")
+                    st.write(
+                        f"**Precio Compra:** {format_currency(op['Precio_Entrada'], moneda_op)}"
+                    )
+                    st.write(
+                        f"**Precio Venta:** {format_currency(op['Precio_Salida'], moneda_op)}"
+                    )
+                with col2:
+                    color = "green" if op["Resultado"] >= 0 else "red"
+                    st.write(
+                        f"**Resultado:** :{color}[{format_currency(op['Resultado'], moneda_op)}]"
+                    )
+                    st.write(f"**ROI:** :{color}[{op['ROI']:.1f}%]")
+                    st.write(f"**Duración:** {op['Duracion']} días")
+                    st.write(f"**Estrategia:** {op['Estrategia']}")
 
-                    if op["Notas"]:
-                        st.write(f"**Notas:** {op['Notas']}")
+                if op["Notas"]:
+                    st.write(f"**Notas:** {op['Notas']}")
 
-                    if st.button("🗑️ Eliminar", key=f"del_{i}"):
-                        st.session_state.libro_trading = (
-                            st.session_state.libro_trading.drop(i).reset_index(
-                                drop=True
-                            )
+                if i not in st.session_state.libro_trading.index:
+                    st.caption("🗄️ Operación archivada (solo lectura)")
+                elif st.button("🗑️ Eliminar", key=f"del_{i}"):
+                    conn = sqlite3.connect("trade_analytics.db")
+                    conn.execute("DELETE FROM operaciones WHERE id = ?", (int(i),))
+                    conn.commit()
+                    conn.close()
+                    cache_tablas().invalidar()
+                    st.success("✅ Operación eliminada")
+                    st.rerun()
+
+        # Estadísticas
+        st.divider()
+        st.subheader("📈 Estadísticas")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Total Operaciones", estadisticas["total_ops"])
+            st.metric("Operaciones Ganadoras", estadisticas["ganadoras"])
+        with col2:
+            st.metric("Tasa de Acierto", f"{estadisticas['tasa_acierto']:.1f}%")
+            st.metric(
+                "Ganancia Total",
+                format_currency(
+                    total_en_moneda(
+                        estadisticas["resultado_por_moneda"], moneda, matriz
+                    ),
+                    moneda,
+                ),
+            )
+
+        st.download_button(
+            "⬇️ Exportar historial (CSV)",
+            # Sin filtros, el archivo se lee recién al pedir la descarga
+            data=libro.to_csv().encode("utf-8") if filtros else exportar_historial,
+            file_name="operaciones.csv",
+            mime="text/csv",
+            use_container_width=True,
+        )
+    elif filtros:
+        st.info("🔎 Ninguna operación coincide con la búsqueda")
+    else:
+        st.info("📝 No hay operaciones registradas")
+
+
+def exportar_historial():
+    """CSV con las operaciones de ambos niveles"""
+    return historial_completo().to_csv().encode("utf-8")
+
+
+@st.fragment
+def seccion_archivo():
+    with st.expander("🗄️ Archivo histórico"):
+        st.caption(
+            f"Las operaciones cerradas hace más de N días pasan a Parquet en "
+            f"`{DIRECTORIO_ARCHIVO}` y siguen en la curva, las estadísticas, la "
+            "búsqueda y la exportación"
+        )
+        st.text("DÍAS DESDE EL CIERRE:")
+        dias = st.number_input(
+            "Horizonte",
+            min_value=1,
+            value=HORIZONTE_ARCHIVO or 365,
+            step=30,
+            label_visibility="collapsed",
+            key="horizonte_archivo",
+        )
+        if st.button("🗄️ Archivar operaciones", use_container_width=True):
+            movidas = archivar_operaciones(int(dias))
+            st.success(f"✅ {movidas} operaciones archivadas")
+            # El historial es otro fragmento: refrescar toda la app
+            st.rerun()
+
+
+@st.fragment
+def seccion_movimientos():
+    st.subheader("🧾 Posiciones por Lotes")
+    st.caption("Compras y ventas parciales, con posiciones que pueden quedar abiertas")
+
+    col1, col2 = st.columns([1, 2])
+
+    with col1:
+        # Sin clear_on_submit: una pierna rechazada conserva lo cargado
+        with st.form("movimiento_lote"):
+            col_fecha, col_lado = st.columns(2)
+            with col_fecha:
+                fecha = st.date_input("FECHA", datetime.now(), key="mov_fecha")
+            with col_lado:
+                lado = st.selectbox("LADO", ["COMPRA", "VENTA"], key="mov_lado")
+
+            col_activo, col_metodo = st.columns(2)
+            with col_activo:
+                activo = st.text_input("ACTIVO", "BTC", key="mov_activo")
+            with col_metodo:
+                metodo = st.selectbox(
+                    "MÉTODO",
+                    METODOS_LOTES,
+                    key="mov_metodo",
+                    help="Cómo se asignan los lotes en una venta",
+                )
+
+            st.text("CANTIDAD:")
+            cantidad = st.number_input(
+                "",
+                min_value=0.0,
+                value=1.0,
+                step=0.001,
+                format="%.3f",
+                key="mov_cantidad",
+            )
+
+            st.text("PRECIO:")
+            precio = st.number_input(
+                "",
+                min_value=0.0,
+                value=1000.0,
+                step=1.0,
+                format="%.2f",
+                key="mov_precio",
+            )
+
+            if st.form_submit_button("💾 GUARDAR MOVIMIENTO"):
+                if activo and cantidad > 0 and precio > 0:
+                    try:
+                        resultado = registrar_movimiento(
+                            str(fecha), activo.upper(), lado, cantidad, precio, metodo
                         )
-                        conn = sqlite3.connect("trade_analytics.db")
-                        conn.execute("DELETE FROM operaciones WHERE id = ?", (i + 1,))
-                        conn.commit()
-                        conn.close()
-                        st.success("✅ Operación eliminada")
-                        st.rerun()
-
-            # Estadísticas
-            st.divider()
-            st.subheader("📈 Estadísticas")
-            total_ops = len(st.session_state.libro_trading)
-            ganadoras = len(
-                st.session_state.libro_trading[
-                    st.session_state.libro_trading["Resultado"] > 0
-                ]
-            )
-            tasa_acierto = (ganadoras / total_ops * 100) if total_ops > 0 else 0
-            ganancia_total = st.session_state.libro_trading["Resultado"].sum()
-
-            col1, col2 = st.columns(2)
-            with col1:
-                st.metric("Total Operaciones", total_ops)
-                st.metric("Operaciones Ganadoras", ganadoras)
-            with col2:
-                st.metric("Tasa de Acierto", f"{tasa_acierto:.1f}%")
-                st.metric("Ganancia Total", format_currency(ganancia_total))
+                        # Los st.success/st.error quedan ocultos por el CSS
+                        if lado == "VENTA":
+                            st.caption(
+                                f"✅ Venta registrada. Resultado realizado: "
+                                f"{format_currency(resultado)}"
+                            )
+                        else:
+                            st.caption("✅ Compra registrada")
+                    except ValueError as e:
+                        st.caption(f"❌ {e}")
+                else:
+                    st.caption("❌ Complete todos los campos")
+
+    with col2:
+        posiciones = valuar_a_mercado(
+            cache_tablas().obtener("posiciones", consultar_posiciones),
+            servicio_cotizaciones().vigentes(),
+        )
+        if posiciones.empty:
+            st.info("📝 No hay movimientos registrados")
         else:
-            st.info("📝 No hay operaciones registradas")
+            abiertas = posiciones[posiciones["Cantidad"] > EPSILON_LOTES]
+            sin_precio = abiertas.loc[abiertas["Precio_Actual"].isna(), "Activo"]
+            col_m1, col_m2 = st.columns(2)
+            with col_m1:
+                st.metric("Posiciones abiertas", len(abiertas))
+                st.metric(
+                    "Costo abierto", format_currency(abiertas["Costo_Total"].sum())
+                )
+            with col_m2:
+                st.metric(
+                    "Resultado realizado",
+                    format_currency(posiciones["Resultado_Realizado"].sum()),
+                )
+                # Una suma parcial se leería como el total: sin todos los precios, "—"
+                st.metric(
+                    "Resultado no realizado",
+                    (
+                        "—"
+                        if len(sin_precio)
+                        else format_currency(abiertas["Resultado_No_Realizado"].sum())
+                    ),
+                )
+            if len(sin_precio):
+                st.caption(
+                    f"⚠️ {len(sin_precio)} posiciones sin cotización en vivo "
+                    f"({', '.join(sin_precio.astype(str))}): el resultado no "
+                    "realizado no se puede totalizar"
+                )
+            st.dataframe(
+                posiciones,
+                column_config={
+                    "Cantidad": st.column_config.NumberColumn(
+                        "Cantidad", format="%.3f"
+                    ),
+                    "Precio_Promedio": st.column_config.NumberColumn(
+                        "Precio Promedio", format="%.2f"
+                    ),
+                    "Costo_Total": st.column_config.NumberColumn(
+                        "Costo Abierto", format="%.2f"
+                    ),
+                    "Resultado_Realizado": st.column_config.NumberColumn(
+                        "Resultado Realizado", format="%.2f"
+                    ),
+                    "Precio_Actual": st.column_config.NumberColumn(
+                        "Precio Actual", format="%.2f"
+                    ),
+                    "Valor_Mercado": st.column_config.NumberColumn(
+                        "Valor de Mercado", format="%.2f"
+                    ),
+                    "Resultado_No_Realizado": st.column_config.NumberColumn(
+                        "No Realizado", format="%.2f"
+                    ),
+                },
+                hide_index=True,
+                use_container_width=True,
+            )
+
 
 # Pestaña 3: TP/SL Calculator - INTELIGENTE (VERSIÓN CORREGIDA)
-with tab3:
+@st.fragment
+def calculadora_tp_sl():
     st.header("🎯 TP/SL Calculator")
     st.info("Calcula Stop Loss y Take Profit automáticamente")
 
@@ -847,33 +2351,69 @@ with tab3:
         st.metric("Ratio Riesgo/Beneficio", f"1 : {ratio_rr:.2f}")
 
         # Gráfico
-        fig, ax = plt.subplots(figsize=(10, 2))
-        ax.barh(
-            [0],
-            [ganancia_potencial],
-            left=[inversion_total],
-            height=0.5,
-            color="green",
-            label="Ganancia",
-        )
-        ax.barh(
-            [0],
-            [perdida_potencial],
-            left=[inversion_total - perdida_potencial],
-            height=0.5,
-            color="red",
-            label="Pérdida",
-        )
-        ax.axvline(x=inversion_total, color="black", linestyle="--", label="Inversión")
-        ax.set_yticks([])
-        ax.set_xlabel("Capital ($)")
-        ax.legend(loc="lower center")
-        ax.grid(True, alpha=0.2, linestyle="--")
-        ax.set_facecolor("#f8f9fa")
-        st.pyplot(fig)
+        if st.session_state.graficos_interactivos:
+            st.altair_chart(
+                grafico_riesgo_beneficio_altair(
+                    inversion_total, perdida_potencial, ganancia_potencial
+                ),
+                use_container_width=True,
+            )
+        else:
+            fig, ax = plt.subplots(figsize=(10, 2))
+            ax.barh(
+                [0],
+                [ganancia_potencial],
+                left=[inversion_total],
+                height=0.5,
+                color="green",
+                label="Ganancia",
+            )
+            ax.barh(
+                [0],
+                [perdida_potencial],
+                left=[inversion_total - perdida_potencial],
+                height=0.5,
+                color="red",
+                label="Pérdida",
+            )
+            ax.axvline(
+                x=inversion_total, color="black", linestyle="--", label="Inversión"
+            )
+            ax.set_yticks([])
+            ax.set_xlabel("Capital ($)")
+            ax.legend(loc="lower center")
+            ax.grid(True, alpha=0.2, linestyle="--")
+            ax.set_facecolor("#f8f9fa")
+            st.pyplot(fig)
     else:
         st.warning("⏳ Ingresa un precio de compra válido para ver los resultados")
 
+
+# Pestañas principales: cada sección es un fragmento que se re-ejecuta por separado
+tab1, tab2, tab3 = st.tabs(["💼 Portafolio", "📈 Trading", "🎯 TP/SL Calculator"])
+
+with tab1:
+    seccion_portafolio()
+
+with tab2:
+    st.header("📈 Libro de Trading")
+    st.info("Registro de operaciones COMPLETAS (compra + venta)")
+
+    col1, col2 = st.columns([1, 2])
+
+    with col1:
+        formulario_nueva_operacion()
+
+    with col2:
+        historial_operaciones()
+
+    st.divider()
+    seccion_movimientos()
+    seccion_archivo()
+
+with tab3:
+    calculadora_tp_sl()
+
 # Footer
 st.divider()
 st.caption("TradeAnalytics Pro © 2024 - Sistema premium de gestión de inversiones")